@@ -1,57 +1,96 @@
 """
 Readout voltage from channel A of PicoScope 2204
 Requires keyboard module (pip install keyboard) to be able to terminate the program with a key/key combination
+Logs are appended to a raw binary file of float64 (timestamp, voltage) pairs, which can be loaded with
+np.fromfile('pressure.bin').reshape(-1, 2). Run with --text to also keep the old text log.
 
 @author: Ilya Radko
 """
 from ps2000 import ps2000
-from time import sleep
+from time import sleep, time
 from datetime import datetime as dt
-from threading import Thread
+from threading import Event
+from math import exp, log
+import argparse
+import os
 import keyboard as kbd
 import numpy as np
 
 
-# Log file name (will be saved in the current working directory)
-logfile = 'pressure.log'
+# Log file names (will be saved in the current working directory)
+logfile = 'pressure.log'  # Text log, only written with --text
+binfile = 'pressure.bin'  # Binary log
 # Define how many log data points to collect and how often
 n_cycles = 100000   # Number of voltage readouts
 loopdelay = 30      # Delay between voltage readouts in seconds
 # Each readout is averaged over several readouts with small delay
 n_avg = 5           # Number of readouts to average over
 avgdelay = 1        # Delay between readouts for averaging
+# Readouts are kept in memory and appended to the log files in batches
+flush_every = 10    # Number of readouts to collect before writing them to disk
+
+# Command line options
+parser = argparse.ArgumentParser(description="Log Pfeiffer gauge pressure read with PicoScope 2000")
+parser.add_argument('--text', action='store_true', help=f"also append readouts to the text log {logfile}")
+args = parser.parse_args()
 
 # Init variables
-time = []     # Save time here
-volt = []     # Save voltage here
-do_measurement = True  # Keep doing measurement?
+time_arr = np.empty(n_cycles, dtype=np.float64)  # Save time here
+volt_arr = np.empty(n_cycles, dtype=np.float64)  # Save voltage here
+flushed = 0   # Number of readouts already written to the log files
+fh = None     # Text log file handle
+bh = None     # Binary log file handle
+shutdown = Event()  # Set when exit is requested
 loop_count = 1 # Loop counter
 
 
-# This thread will wait for Ctrl+Alt+q sequence to quit
-def readkey_thread():
-    global do_measurement
-    # kbd.wait('ctrl+alt+q')
-    # print("\033[91m" + "Terminating after next readout..." + "\033[0m")
-    # do_measurement = False
-    while do_measurement:
-        kbd.read_key()
-        if kbd.is_pressed('ctrl+alt+q'):
-            print("\033[91m" + "Stopping..." + "\033[0m")
-            do_measurement = False
-        # else:
-        #     sleep(1)
+# Hotkey callback: called by the keyboard module when Ctrl+Alt+q is pressed
+def on_quit():
+    print("\033[91m" + "Stopping..." + "\033[0m")
+    shutdown.set()
+
+
+# Append readouts not yet written to the log files
+def flush_log():
+    global flushed
+    n = loop_count - 1  # Number of readouts done so far
+    if n == flushed:
+        return
+    rows = np.column_stack((time_arr[flushed:n], volt_arr[flushed:n]))
+    if fh is not None:
+        fh.write("".join(f"{t:10.0f} {v:10.6f}\n" for t, v in rows))
+        fh.flush()
+    rows.tofile(bh)
+    bh.flush()
+    flushed = n
+
+
+# Write out whatever is left and close the log files
+def close_log():
+    try:
+        flush_log()
+    finally:
+        if fh is not None:
+            fh.close()
+        if bh is not None:
+            bh.close()
+
+
+# Coefficients for converting voltage to pressure: p = 10**(a*V-b) mbar
+# Values from Preiffer manual
+a = 1.667
+b = 11.46
+# Values from Yannik's calibration
+#a = 1.674
+#b = 11.46
+# Same formula as exp(ln10*a*V - ln10*b), with the constants folded once at import
+_LN10_A = a*log(10)
+_LN10_B = b*log(10)
 
 
 # Convert voltage to pressure in mbar
 def v2mbar(V):
-    # Values from Preiffer manual
-    a = 1.667
-    b = 11.46
-    # Values from Yannik's calibration
-    #a = 1.674
-    #b = 11.46
-    return 10**(a*V-b)
+    return exp(_LN10_A*V - _LN10_B)
 
 
 # Main loop
@@ -64,39 +103,55 @@ if handle > 0:
         scope.setTrigger(source=None)  # Disable trigger (source = None)
         scope.setSampling(no_of_samples=10, extra_ADC_bits=4)
 
-        # Create a thread that will wait for Esc key to finish measurements
-        Thread(target=readkey_thread, daemon=True).start()
-        print(f'Reading data from pressure gauge every {loopdelay} sec. Logs will be saved to {logfile}')
+        # Register a hotkey that will finish measurements
+        kbd.add_hotkey('ctrl+alt+q', on_quit)
+        logs = f'{binfile} and {logfile}' if args.text else binfile
+        print(f'Reading data from pressure gauge every {loopdelay} sec. Logs will be saved to {logs}')
         print("\033[92m" + "Press Ctrl+Alt+q to finish" + "\033[0m")
         start = dt.now()
+        # Open the log files once and append to them
+        bh = open(binfile, 'ab', buffering=64*1024)
+        if args.text:
+            # Write a header only for a new text log
+            new_file = not os.path.exists(logfile) or os.path.getsize(logfile) == 0
+            fh = open(logfile, 'a', buffering=64*1024)
+            if new_file:
+                fh.write(f"# {start}\n")
 
-        while do_measurement:
+        while not shutdown.is_set():
             # Make several readouts and average
             V_list = []
             for i in range(n_avg):
-                v1 = scope.getVoltage()
+                # Arm the block first: it is collected by the scope while we wait avgdelay
+                if scope.runBlock() == 0:
+                    print("Error getting voltage. Skipping this iteration.")
+                    continue
+                sleep(avgdelay)
+                v1 = scope.readBlock()
                 if v1 == 0:
                     print("Error getting voltage. Skipping this iteration.")
                     continue
                 V_list.append(v1[0]) # Save value from channel A
-                sleep(avgdelay)
-            voltage = np.mean(V_list) # Average over n_avg readouts
-            now = dt.now()
+            # Average over n_avg readouts (NaN if all of them failed, as np.mean() gave before)
+            voltage = sum(V_list)/len(V_list) if V_list else float('nan')
+            ts = time()  # Timestamp (seconds since 01.01.1970)
+            now = dt.fromtimestamp(ts)  # Only needed for printing
             mbar = v2mbar(voltage) # Convert voltage to mbar
             print(f"{now}:   {voltage:.3f} V    {mbar:.3e} mbar")
-            # Save time in timestamps (seconds since 01.01.1970)
-            time.append(dt.timestamp(now))
-            volt.append(voltage)
+            time_arr[loop_count-1] = ts
+            volt_arr[loop_count-1] = voltage
             loop_count += 1
+            if loop_count - 1 - flushed >= flush_every:
+                flush_log()
             if loop_count > n_cycles:
                 break
-            # Sleep, but check regularly if exit is requested
-            for i in range(round(loopdelay)):
-                sleep(1)
-                if not do_measurement:
-                    break
-        np.savetxt(logfile, np.transpose((time, volt)), fmt=('%10.0f','%10.6f'), header=f'{start}')
+            # Sleep, but wake up immediately if exit is requested
+            if shutdown.wait(timeout=loopdelay):
+                break
     finally:
-        scope.close()
+        try:
+            close_log()
+        finally:
+            scope.close()
 
 
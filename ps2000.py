@@ -7,23 +7,35 @@ No ETS (higher time resolution for periodic signals) functionality yet.
 """
 
 import os
-from ctypes import cdll, c_int16, c_int32, byref, create_string_buffer
+from ctypes import cdll, c_int16, c_int32, c_char_p, byref, create_string_buffer, POINTER
 from time import sleep
 from math import log2, ceil
+import numpy as np
+
+# PicoScope INFO constants - used by ps2000_get_unit_info():
+INFO_DRV_VERSION   = 0  # Version number of the DLL used
+INFO_USB_VERSION   = 1  # USB version used for connection (e.g., "1.1", "2.0", "3.0")
+INFO_HW_VERSION    = 2  # E.g., "1"
+INFO_MODEL_NUMBER  = 3  # E.g., "2204A"
+INFO_SERIAL_NUMBER = 4  # E.g., "IT834/502"
+INFO_CALIBR_DATE   = 5  # Calibration date, e.g. "06Jul20"
+INFO_ERROR_CODE    = 6  # Current error code (see getError() for details)
+INFO_KRNL_DRV_VER  = 7  # Version number of the kernel driver (low-level driver)
+INFO_DRIVER_PATH   = 8  # Path of the currently used DLL driver
 
 class ps2000:
 
-    # PicoScope INFO constants - used by ps2000_get_unit_info():
+    # PicoScope INFO constants by name (same values as the module-level INFO_* constants)
     PS_INFO = {
-        "drv_version":  c_int16(0),     # Version number of the DLL used
-        "usb_version":  c_int16(1),     # USB version used for connection (e.g., "1.1", "2.0", "3.0")
-        "hw_version":   c_int16(2),     # E.g., "1"
-        "model_number": c_int16(3),     # E.g., "2204A"
-        "serial_number":c_int16(4),     # E.g., "IT834/502"
-        "calibr_date":  c_int16(5),     # Calibration date, e.g. "06Jul20"
-        "error_code":   c_int16(6),     # Current error code (see getError() for details)
-        "krnl_drv_ver": c_int16(7),     # Version number of the kernel driver (low-level driver)
-        "driver_path":  c_int16(8)      # Path of the currently used DLL driver
+        "drv_version":  INFO_DRV_VERSION,
+        "usb_version":  INFO_USB_VERSION,
+        "hw_version":   INFO_HW_VERSION,
+        "model_number": INFO_MODEL_NUMBER,
+        "serial_number":INFO_SERIAL_NUMBER,
+        "calibr_date":  INFO_CALIBR_DATE,
+        "error_code":   INFO_ERROR_CODE,
+        "krnl_drv_ver": INFO_KRNL_DRV_VER,
+        "driver_path":  INFO_DRIVER_PATH
     }
 
     # PicoScope voltage range constants - used by getRange() and setTrigger():
@@ -43,31 +55,63 @@ class ps2000:
         "max_range": 12
     }
 
+    # Full-scale voltage in mV for each range constant (index = PS_RANGE value) - used by adc2mV() and mV2adc():
+    _MV_RANGES = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
     # PicoScope measurement coupling mode
     PS_COUPLING = {
-        "AC": c_int16(0),
-        "DC": c_int16(1)
+        "AC": 0,
+        "DC": 1
     }
 
     # ADC constant: max value returned by ADC
     PS_MAX_ADC_VALUE = 32767
 
+    # DLL function prototypes (restype, argtypes) - declared once in __init__(),
+    # so ctypes does not have to infer argument types on every call
+    _PROTOTYPES = {
+        "ps2000_apply_fix":     (None,    [c_int32, c_int16]),
+        "ps2000_open_unit":     (c_int16, []),
+        "ps2000_close_unit":    (c_int16, [c_int16]),
+        "ps2000_get_unit_info": (c_int16, [c_int16, c_char_p, c_int16, c_int16]),
+        "ps2000_set_channel":   (c_int16, [c_int16]*5),
+        "ps2000_set_trigger":   (c_int16, [c_int16]*6),
+        "ps2000_set_ets":       (c_int32, [c_int16]*4),
+        "ps2000_get_timebase":  (c_int16, [c_int16, c_int16, c_int32, POINTER(c_int32), POINTER(c_int16),
+                                           c_int16, POINTER(c_int32)]),
+        "ps2000_run_block":     (c_int16, [c_int16, c_int32, c_int16, c_int16, POINTER(c_int32)]),
+        "ps2000_ready":         (c_int16, [c_int16]),
+        "ps2000_get_values":    (c_int32, [c_int16] + [POINTER(c_int16)]*5 + [c_int32]),
+        "ps2000_stop":          (c_int16, [c_int16]),
+        "ps2000PingUnit":       (c_int16, [c_int16])
+    }
+
     # Channel enumeration
     chDict = {0: "A", 1: "B", 2: "C", 3: "D"}
 
     def __init__(self):
         # Load dll from the same folder as this module
         path = os.path.dirname(os.path.realpath(__file__))
-        self.dll = cdll.LoadLibrary(path + "\ps2000.dll")
+        self.dll = cdll.LoadLibrary(os.path.join(path, "ps2000.dll"))
+        # Declare prototypes of all used DLL functions
+        for name, (restype, argtypes) in self._PROTOTYPES.items():
+            func = getattr(self.dll, name)
+            func.restype = restype
+            func.argtypes = argtypes
         # Device variables
-        self.handle = c_int16(0)  # PicoScope handle (0 = no device)
+        self.handle = 0           # PicoScope handle (0 = no device)
         self.info = {}  # Device info dictionary
         self.channel = [False, False, False, False]  # Channels on which measurements are taken (0: A, 1: B, 2: C, 3: D)
         self.range = [12, 12, 12, 12]    # Currently selected range on channels (Max_range, see PS_RANGE)
         self.trigger_range = 12          # Range for the trigger (seems to be the last configured range on a channel?)
-        self.oversample = c_int16(0)     # Currently selected oversample (see setSampling() for details)
-        self.no_of_samples = c_int32(0)  # Number of samples to collect in one block
-        self.timebase = c_int16(0)       # Sampling interval on log_2 scale (see setSampling() for details)
+        self.oversample = 0              # Currently selected oversample (see setSampling() for details)
+        self.no_of_samples = 0           # Number of samples to collect in one block
+        self.timebase = 0                # Sampling interval on log_2 scale (see setSampling() for details)
+        self._buf = None                 # Pointers to buffers receiving data from four channels (see _allocBuffers())
+        self._adc = None                 # Data of enabled channels, one row per channel (see _allocBuffers())
+        self._enabled = []               # Channels corresponding to the rows of self._adc
+        self._V_per_count = None         # ADC count to Volts conversion factor for each row of self._adc
+        self.collection_time_ms = 0      # Time needed to collect the block started by the last runBlock()
 
 
     def open(self):
@@ -76,19 +120,21 @@ class ps2000:
         @return: handle (>0), 0 (no PS device found), or -1 (found, but fails to open)
         """
         # If device is already opened, then close it first (will reset it)
-        if self.handle.value > 0:
+        if self.handle > 0:
             self.close()
         # Undocumented fix to hide splash screen
-        self.dll.ps2000_apply_fix(c_int32(0x1ced9168), c_int32(0x11e6))
-        self.handle.value = self.dll.ps2000_open_unit()
-        if self.handle.value < 0:
+        self.dll.ps2000_apply_fix(0x1ced9168, 0x11e6)
+        # ps2000_open_unit() returns int16_t: keep only 16 bits, so the sign checks below stay valid
+        # even if the DLL prototypes were not declared
+        self.handle = c_int16(self.dll.ps2000_open_unit()).value
+        if self.handle < 0:
             print("PicoScope fails to open")
-        elif self.handle.value == 0:
+        elif self.handle == 0:
             print("No PicoScope device found")
         else:
             self.getDeviceInfo()
             print(f"Found PicoScope {self.info['name']}, calibrated on {self.info['calib']}")
-        return self.handle.value
+        return self.handle
 
 
     def close(self):
@@ -97,14 +143,16 @@ class ps2000:
         @return: 0 if handle is not valid
         """
         self.dll.ps2000_close_unit(self.handle)
-        self.handle.value = 0
+        self.handle = 0
         self.info = {}
         self.channel = [False, False, False, False]  # Channels on which measurements are taken (0: A, 1: B, 2: C, 3: D)
         self.range = [12, 12, 12, 12]   # Currently selected range on channels (Max_range, see PS_RANGE)
         self.trigger_range = 12  # Range for the trigger
-        self.oversample.value = 0
-        self.no_of_samples.value = 0
-        self.timebase.value = 0
+        self.oversample = 0
+        self.no_of_samples = 0
+        self.timebase = 0
+        self._buf = None
+        self.collection_time_ms = 0
 
 
     def getDeviceInfo(self):
@@ -115,12 +163,12 @@ class ps2000:
         """
         buf = create_string_buffer(b'\x00' * 256)    # 256-byte buffer should be sufficient
         # Request the name of the PicoScope variant
-        strlen = self.dll.ps2000_get_unit_info(self.handle, buf, c_int16(len(buf)), self.PS_INFO["model_number"])
+        strlen = self.dll.ps2000_get_unit_info(self.handle, buf, len(buf), INFO_MODEL_NUMBER)
         if strlen != 0:
             self.info['name'] = buf.value.decode("utf-8")
 
         # Request the device calibration date
-        strlen = self.dll.ps2000_get_unit_info(self.handle, buf, c_int16(len(buf)), self.PS_INFO["calibr_date"])
+        strlen = self.dll.ps2000_get_unit_info(self.handle, buf, len(buf), INFO_CALIBR_DATE)
         if strlen != 0:
             self.info['calib'] = buf.value.decode("utf-8")
 
@@ -133,7 +181,7 @@ class ps2000:
         bufLen = 8  # 8-byte buffer should be sufficient
         buf = create_string_buffer(b'\x00' * bufLen)
         # Request the current status code of the PicoScope
-        strlen = self.dll.ps2000_get_unit_info(self.handle, buf, c_int16(bufLen), self.PS_INFO["error_code"])
+        strlen = self.dll.ps2000_get_unit_info(self.handle, buf, bufLen, INFO_ERROR_CODE)
         # Try to convert the status code string to integer
         if strlen == 0:
             print("Could not obtain the status code of the PicoScope.")
@@ -199,12 +247,19 @@ class ps2000:
 
         @param int rawADC: raw ADC value returned by the PicoScope.
         @param int range: currently configured range constant
-        @return: list of mV values converted from rawADC values
+        @return: mV value converted from rawADC value
         """
-        # Get voltage range in mV based on range constant:
-        ranges = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000]
-        mVrange = ranges[range]
-        return (rawADC * mVrange)/self.PS_MAX_ADC_VALUE
+        return rawADC * (self._MV_RANGES[range]/self.PS_MAX_ADC_VALUE)
+
+
+    def adc2mV_array(self, arr, range):
+        """ Convert a whole buffer of raw ADC values to voltage (in mV) based on the current PicoScope range
+
+        @param arr: array-like of raw ADC values returned by the PicoScope.
+        @param int range: currently configured range constant
+        @return: numpy array of mV values converted from raw ADC values
+        """
+        return np.asarray(arr, dtype=np.float64) * (self._MV_RANGES[range]/self.PS_MAX_ADC_VALUE)
 
 
     def mV2adc(self, mV, range):
@@ -214,9 +269,7 @@ class ps2000:
         @param int range: currently configured range constant
         @return: raw ADC value converted from voltage
         """
-        ranges = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000]
-        mVrange = ranges[range]
-        return round((mV * self.PS_MAX_ADC_VALUE)/mVrange)
+        return round((mV * self.PS_MAX_ADC_VALUE)/self._MV_RANGES[range])
 
 
     def setChannel(self, channel, state, Vmax, coupling=1):
@@ -237,11 +290,11 @@ class ps2000:
         self.range[channel] = self.getRange(Vmax)
         # Trigger range seems to be the last configured range on a channel(?)
         self.trigger_range = self.range[channel]
-        code = self.dll.ps2000_set_channel(self.handle, c_int16(channel), c_int16(state),
-                                           c_int16(coupling), c_int16(self.range[channel]))
+        code = self.dll.ps2000_set_channel(self.handle, channel, state, coupling, self.range[channel])
         if code == 0:
             print(f"Failed to set up channel {self.chDict[channel]}.")
             self.getError()
+        self._buf = None  # Set of enabled channels may have changed
 
         return code
 
@@ -261,9 +314,7 @@ class ps2000:
         threshold = self.mV2adc(level*1000, self.trigger_range)
         if source is None:
             source = 5  # PicoScope constant to disable trigger
-        code = self.dll.ps2000_set_trigger(self.handle, c_int16(source),
-                                           c_int16(threshold), c_int16(edge),
-                                           c_int16(delay), c_int16(timeout))
+        code = self.dll.ps2000_set_trigger(self.handle, source, threshold, edge, delay, timeout)
         if code == 0:
             print("Failed to set up a trigger.")
             self.getError()
@@ -290,9 +341,10 @@ class ps2000:
         @return: 0 on error, non-zero on success
         """
         # Calculate oversample ratio: oversampling_interval/sampling_interval
-        self.oversample.value = round(4**extra_ADC_bits)
+        self.oversample = round(4**extra_ADC_bits)
         # Save to class attribute
-        self.no_of_samples.value = no_of_samples
+        self.no_of_samples = no_of_samples
+        self._buf = None  # Buffers must match the new number of samples
         # Check minimum required timebase
         enabled_channels = self.channel.count(True)  # Number of enabled channels
         if enabled_channels == 0:
@@ -303,7 +355,7 @@ class ps2000:
             print(f"Timebase value of {timebase} is too small. For {enabled_channels} enabled channels, ",
                   f"it has to be at least {min_timebase}. Setting it to the minimum required.")
             timebase = min_timebase
-        self.timebase.value = timebase
+        self.timebase = timebase
         # Prepare return variables (sent as pointers)
         time_interval = c_int32()  # Effective time interval between samples
         time_units = c_int16()     # Most suitable time units (needed for other API calls)
@@ -320,14 +372,44 @@ class ps2000:
         if max_samples.value < no_of_samples:
             print(f"Not enough memory for the requested number of samples in a single block." +
                   f"Decreasing it to {max_samples.value}.")
-            self.no_of_samples = max_samples
+            self.no_of_samples = max_samples.value
+        self._allocBuffers()
 
         # Debug message:
-        # print(f"Recording data in blocks of {self.no_of_samples.value} samples with " +
+        # print(f"Recording data in blocks of {self.no_of_samples} samples with " +
         #       f"{time_interval.value} ns interval between samples.")
         return code
 
 
+    def _checkConnection(self):
+        """ Check if the device is still connected after a failed call, and print the reason of the failure.
+        The device is not pinged on every readout, only when something went wrong.
+
+        @return: 0 if the device is not responding, non-zero otherwise
+        """
+        code = self.dll.ps2000PingUnit(self.handle)
+        if code == 0:
+            print("PicoScope is not responding. Reconnect it and open() it again.")
+        self.getError()
+        return code
+
+
+    def _allocBuffers(self):
+        """ Prepare buffers to receive data from the four channels.
+        Data of all enabled channels is received into one (n_enabled, no_of_samples) array,
+        so that all channels can be averaged with a single NumPy call. self._buf holds
+        a pointer to the corresponding row for every enabled channel, None otherwise.
+        The buffers are reused by all subsequent readBlock() calls.
+        """
+        self._enabled = [i for i in range(4) if self.channel[i]]
+        self._adc = np.zeros((len(self._enabled), self.no_of_samples), dtype=np.int16)
+        self._buf = [None, None, None, None]
+        for row, ch in enumerate(self._enabled):
+            self._buf[ch] = self._adc[row].ctypes.data_as(POINTER(c_int16))
+        mV_ranges = np.array([self._MV_RANGES[self.range[ch]] for ch in self._enabled], dtype=np.float64)
+        self._V_per_count = mV_ranges/self.PS_MAX_ADC_VALUE/1000
+
+
     def getVoltage(self):
         """Read out voltage as configured with setChannel(), setTrigger(), setSampling() and return
         a list of readings from all four channels in Volts
@@ -335,52 +417,72 @@ class ps2000:
         @return: List of voltages in Volts
         TODO: processing of overflow variable
         """
-        # Check if the device is still connected
-        code = self.dll.ps2000PingUnit(self.handle)
+        code = self.runBlock()
         if code == 0:
-            print("Could not start measurements is Block mode.")
-            self.getError()
             return code
+        # Wait for the sampling to finish
+        sleep(self.collection_time_ms/1000)    # sleep() takes time in seconds
+        return self.readBlock()
+
+
+    def runBlock(self):
+        """Start collecting one block of data in Block mode, as configured with setChannel(),
+        setTrigger() and setSampling(). The block is collected by the device in the background
+        and read out with readBlock(), so the caller may do other work meanwhile.
+        Time needed to collect the block is saved in self.collection_time_ms.
+
+        @return: 0 on error, non-zero on success
+        """
         # Start sampling in Block mode
         collection_time_ms = c_int32(0)
         code = self.dll.ps2000_run_block(self.handle, self.no_of_samples, self.timebase,
                                          self.oversample, byref(collection_time_ms))
         if code == 0:
             print("Error recording data in block mode.")
-            self.getError()
+            self._checkConnection()
             return code
-        # Wait for the sampling to finish
-        sleep(collection_time_ms.value/1000)    # sleep() takes time in seconds
-        while self.dll.ps2000_ready(self.handle) == 0:
-            sleep(0.005)  # Sleep for 5 ms
+        self.collection_time_ms = collection_time_ms.value
+        return code
+
+
+    def readBlock(self):
+        """Wait for the block started by runBlock() to be collected and return
+        a list of readings from all four channels in Volts
+
+        @return: List of voltages in Volts
+        """
+        # Look up the DLL function and handle once, outside of the polling loop
+        handle = self.handle
+        ready = self.dll.ps2000_ready
+        # Poll with exponential backoff: start at 50 us, but never sleep longer than 5 ms
+        delay = 5e-5
+        while ready(handle) == 0:
+            sleep(delay)
+            delay = min(delay*2, 0.005)
         # Getting the values
-        # Prepare four buffers to read voltage from four channels
-        buf = [None, None, None, None]
-        for i in range(4):
-            if self.channel[i]:  # Channel enabled? If so, prepare an array to receive data from PicoScope.
-                buf[i] = (c_int16 * self.no_of_samples.value)()  # Last pair of brackets are to instantiate the array
+        if self._buf is None or self._adc.shape[1] != self.no_of_samples:
+            self._allocBuffers()
+        buf = self._buf
         overflow = c_int16(0)  # overflow bitmask
-        samples = self.dll.ps2000_get_values(self.handle, buf[0], buf[1], buf[2], buf[3],
+        samples = self.dll.ps2000_get_values(handle, buf[0], buf[1], buf[2], buf[3],
                                              byref(overflow), self.no_of_samples)
         # Stopping block mode
-        code = self.dll.ps2000_stop(self.handle)
+        code = self.dll.ps2000_stop(handle)
         if code == 0:
             self.getError()
             return code
         # Processing the returned data
         overflow = overflow.value  # Convert to regular int value
         if samples == 0:
-            self.getError()
+            print("Error reading data recorded in block mode.")
+            self._checkConnection()
             return samples
-        # Averaging the returned data
+        # Averaging the returned data of all enabled channels at once, in Volts
+        means = self._adc[:, :samples].mean(axis=1, dtype=np.float64) * self._V_per_count
         voltage = [None, None, None, None]  # Voltage read-out from four channels
-        for ch in range(4):
-            if self.channel[ch]:  # Channel enabled?
-                total = 0
-                for i in range(samples):
-                    total += buf[ch][i]
-                voltage[ch] = self.adc2mV(total/samples, self.range[ch])/1000  # Averaged voltage in Volts
-                if (overflow >> ch) & 1 == 1:  # Overflow on this channel?
-                    print(f"Warning: overflow on channel {self.chDict[ch]}")
+        for row, ch in enumerate(self._enabled):
+            voltage[ch] = float(means[row])
+            if (overflow >> ch) & 1 == 1:  # Overflow on this channel?
+                print(f"Warning: overflow on channel {self.chDict[ch]}")
         return voltage
 